@@ -14,23 +14,36 @@ Autor: FOTZ Studio
 import os
 import re
 import io
+import html
+import json
+import time
+import hashlib
+import asyncio
+import functools
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import zlib
 import zipfile
 import tempfile
-import requests
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+import httpx
 
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
+from starlette.exceptions import HTTPException as StarletteHTTPException
 
-import markdown
-from weasyprint import HTML, CSS
-from PyPDF2 import PdfMerger
+import cmarkgfm
+from cmarkgfm.cmark import Options as CmarkOptions
+from zipstream import ZipStream
+from playwright.async_api import async_playwright
+import pikepdf
+import pyvips
 from PIL import Image
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
 
 # =============================================================================
 # KONFIGURACJA
@@ -39,7 +52,8 @@ from reportlab.lib.pagesizes import A4
 app = FastAPI(
     title="FOTZ PDF Microservice",
     description="Mikroserwis do generowania PDF dla FOTZ Ebook Factory",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS - pozwól na połączenia z Lovable
@@ -58,18 +72,60 @@ BRANDING = {
     "accent_color": "#C9A227",       # Złoty
 }
 
-PAGE_WIDTH, PAGE_HEIGHT = A4
+# Rozmiar strony A4 w punktach
+PAGE_WIDTH, PAGE_HEIGHT = 210 / 25.4 * 72, 297 / 25.4 * 72
+
+# Silnik renderujący HTML -> PDF: "chromium" (domyślnie) lub "weasyprint"
+RENDERERS = ("chromium", "weasyprint")
+RENDERER = os.environ.get("RENDERER", "chromium").strip().lower()
+if RENDERER not in RENDERERS:
+    raise ValueError(f"Nieznany RENDERER={RENDERER!r}, dozwolone: {', '.join(RENDERERS)}")
+
+def get_default_workers() -> int:
+    """
+    Domyślna liczba procesów: rdzenie dostępne dla procesu (affinity), najwyżej 4.
+    
+    os.cpu_count() zwraca rdzenie hosta, a nie limit kontenera - na Railway
+    uruchomiłoby to dziesiątki interpreterów. Więcej ustawia się przez PDF_WORKERS.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        available = len(os.sched_getaffinity(0))
+    else:
+        available = os.cpu_count() or 1
+    return max(1, min(available, 4))
+
+
+# Liczba procesów do pracy CPU (WeasyPrint, składanie PDF); też limit równoległych
+# grup rozdziałów renderowanych jednocześnie dla jednego dokumentu
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", get_default_workers()))
+
+# Cache pobranych obrazów na dysku (klucz: SHA-256 z URL)
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "/tmp/fotz_img_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_MB", 1024)) * 1024 * 1024
+# Sekundy, przez które obraz z cache jest używany bez pytania serwera; domyślnie 0 -
+# zawsze rewalidacja (ETag / Last-Modified), aby podmieniona okładka pod tym samym URL trafiła do PDF
+IMAGE_CACHE_TTL = int(os.environ.get("IMAGE_CACHE_TTL", 0))
+
+# Maksymalny bok osadzanego obrazu w px - A4 przy 300 DPI (2480 x 3508)
+MAX_IMAGE_PX = 3508
+
+# Duże ebooki (od tylu znaków HTML) renderowane są równolegle, w grupach rozdziałów
+CHAPTER_SPLIT_MIN_CHARS = int(os.environ.get("CHAPTER_SPLIT_MIN_CHARS", 200_000))
 
 # =============================================================================
 # MODELE PYDANTIC
 # =============================================================================
 
 class TocItem(BaseModel):
+    model_config = ConfigDict(extra='ignore')
+    
     title: str
     page: int
 
 class PdfRequest(BaseModel):
-    content: str  # Przetłumaczona treść Markdown
+    model_config = ConfigDict(extra='ignore')
+    
+    content: str = Field(..., repr=False)  # Przetłumaczona treść Markdown
     title: str
     subtitle: Optional[str] = "Poradnik"
     author: Optional[str] = "FOTZ Studio"
@@ -80,7 +136,9 @@ class PdfRequest(BaseModel):
     logo_url: Optional[str] = None
 
 class ZipRequest(BaseModel):
-    pdf_content: str
+    model_config = ConfigDict(extra='ignore')
+    
+    pdf_content: str = Field(..., repr=False)
     title: str
     subtitle: Optional[str] = "Poradnik"
     author: Optional[str] = "FOTZ Studio"
@@ -90,8 +148,8 @@ class ZipRequest(BaseModel):
     mockup_url: Optional[str] = None
     infographic_urls: Optional[List[str]] = None
     logo_url: Optional[str] = None
-    blog_post: Optional[str] = None
-    shop_description: Optional[str] = None
+    blog_post: Optional[str] = Field(None, repr=False)
+    shop_description: Optional[str] = Field(None, repr=False)
 
 # =============================================================================
 # FUNKCJE FORMATOWANIA FOTZ
@@ -105,6 +163,15 @@ PROPER_NOUNS = [
     "ICE", "EVP", "SOP", "AI", "API", "DeepL", "FOTZ"
 ]
 
+# Mapa małe litery -> poprawna pisownia nazwy własnej
+_PROPER_NOUNS_MAP = {pn.lower(): pn for pn in PROPER_NOUNS}
+
+# Nagłówki poziomu 2-4: (prefiks "##", treść tytułu)
+_TITLE_RE = re.compile(r'^(#{2,4})\s+(.+)$', re.MULTILINE)
+
+# Polskie końcówki doklejane do rdzenia słowa kluczowego (do 6 znaków)
+_POLISH_ENDINGS = r'[a-ząćęłńóśźż]{0,6}'
+
 def standardize_titles(content: str) -> str:
     """
     Standaryzuje tytuły zgodnie z zasadami polszczyzny.
@@ -121,45 +188,57 @@ def standardize_titles(content: str) -> str:
         result = [words[0].capitalize()]
         
         for word in words[1:]:
-            is_proper = any(pn.lower() == word.lower() for pn in PROPER_NOUNS)
-            if is_proper:
-                for pn in PROPER_NOUNS:
-                    if pn.lower() == word.lower():
-                        result.append(pn)
-                        break
-            else:
-                result.append(word.lower())
+            lower = word.lower()
+            result.append(_PROPER_NOUNS_MAP.get(lower, lower))
         
         return f"{prefix} {' '.join(result)}"
     
-    pattern = r'^(#{2,4})\s+(.+)$'
-    content = re.sub(pattern, process_title, content, flags=re.MULTILINE)
+    return _TITLE_RE.sub(process_title, content)
+
+
+@functools.lru_cache(maxsize=128)
+def get_keywords_pattern(keywords: Tuple[str, ...]) -> Optional[re.Pattern]:
+    """
+    Buduje (raz na zestaw słów) jeden wzorzec dla wszystkich słów kluczowych.
+    Dłuższe słowa najpierw, aby "treści" wygrywało z "treść".
+    """
+    unique_keywords = sorted({k.lower(): k for k in keywords if k}.values(), key=len, reverse=True)
+    if not unique_keywords:
+        return None
     
-    return content
+    return re.compile(
+        r'(?<!\*\*)(' + '|'.join(re.escape(k) for k in unique_keywords) + r')'
+        + _POLISH_ENDINGS + r'(?!\*\*)',
+        re.IGNORECASE
+    )
 
 
 def apply_bold_keywords(content: str, keywords: List[str]) -> str:
     """
     Automatycznie pogrubia słowa kluczowe z polskimi końcówkami.
+    Każde słowo kluczowe pogrubiane jest tylko przy pierwszym wystąpieniu w akapicie.
     """
     if not keywords:
         return content
     
-    for keyword in keywords:
-        # Regex uwzględniający polskie końcówki (do 6 znaków po rdzeniu)
-        pattern = rf'(?<!\*\*)({re.escape(keyword)}[a-ząćęłńóśźż]{{0,6}})(?!\*\*)'
+    pattern = get_keywords_pattern(tuple(keywords))
+    if pattern is None:
+        return content
+    
+    def bold_paragraph(para):
+        seen = set()
         
-        def replace_first_in_paragraph(text):
-            paragraphs = text.split('\n\n')
-            result = []
-            for para in paragraphs:
-                para = re.sub(pattern, r'**\1**', para, count=1, flags=re.IGNORECASE)
-                result.append(para)
-            return '\n\n'.join(result)
+        def replace_first(match):
+            keyword = match.group(1).lower()
+            if keyword in seen:
+                return match.group(0)
+            seen.add(keyword)
+            return f"**{match.group(0)}**"
         
-        content = replace_first_in_paragraph(content)
+        return pattern.sub(replace_first, para)
     
-    return content
+    # Jeden przebieg po akapitach niezależnie od liczby słów kluczowych
+    return '\n\n'.join(bold_paragraph(para) for para in content.split('\n\n'))
 
 
 def process_content(content: str, keywords: Optional[List[str]] = None) -> str:
@@ -175,6 +254,22 @@ def process_content(content: str, keywords: Optional[List[str]] = None) -> str:
     
     return content
 
+
+@functools.lru_cache(maxsize=64)
+def render_content_html(content: str, keywords: Tuple[str, ...]) -> str:
+    """
+    Formatuje treść zasadami FOTZ i konwertuje Markdown na HTML.
+    
+    Wynik jest zapamiętywany - ponowne generowanie tej samej treści (np. po zmianie
+    okładki) pomija wszystkie przebiegi regexów i parsowanie Markdown.
+    """
+    processed_content = process_content(content, list(keywords))
+    
+    # GFM: tabele i bloki kodu natywnie, surowy HTML przepuszczany
+    return cmarkgfm.github_flavored_markdown_to_html(
+        processed_content, options=CmarkOptions.CMARK_OPT_UNSAFE
+    )
+
 # =============================================================================
 # GENEROWANIE CSS
 # =============================================================================
@@ -182,17 +277,9 @@ def process_content(content: str, keywords: Optional[List[str]] = None) -> str:
 def get_fotz_css() -> str:
     """Zwraca CSS zgodny z brandingiem FOTZ."""
     return f'''
-@import url('https://fonts.googleapis.com/css2?family=Open+Sans:wght@400;600;700&display=swap');
-
 @page {{
     size: A4;
     margin: 2cm 2cm 2.5cm 2cm;
-    @bottom-center {{
-        content: counter(page);
-        font-family: 'Open Sans', sans-serif;
-        font-size: 10pt;
-        color: #666;
-    }}
 }}
 
 body {{
@@ -311,32 +398,223 @@ li {{
 }}
 '''
 
+
+# CSS budowany raz przy starcie; Open Sans pochodzi z fontów systemowych (fonts-open-sans)
+FOTZ_CSS = get_fotz_css()
+
+
+@functools.lru_cache(maxsize=None)
+def get_weasyprint_stylesheet():
+    """Zwraca arkusz FOTZ sparsowany przez WeasyPrint raz na proces."""
+    from weasyprint import CSS
+    return CSS(string=FOTZ_CSS)
+
 # =============================================================================
 # GENEROWANIE PDF
 # =============================================================================
 
-def download_image(url: str, temp_dir: str, filename: str) -> Optional[str]:
-    """Pobiera obraz z URL i zapisuje lokalnie."""
+def get_cache_paths(url: str) -> Tuple[str, str]:
+    """Zwraca ścieżki (dane, metadane) wpisu cache dla danego URL."""
+    key = hashlib.sha256(url.encode()).hexdigest()
+    data_path = os.path.join(IMAGE_CACHE_DIR, key)
+    return data_path, f"{data_path}.json"
+
+
+def store_cached_image(url: str, content: bytes, headers: httpx.Headers) -> None:
+    """Zapisuje obraz i jego nagłówki rewalidacji (ETag, Last-Modified) w cache."""
+    data_path, meta_path = get_cache_paths(url)
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    
+    meta = {
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last-modified"),
+    }
+    
+    # Zapis przez plik tymczasowy + os.replace - równoległe żądania nie widzą połówek
+    for path, data in ((data_path, content), (meta_path, json.dumps(meta).encode())):
+        fd, tmp_path = tempfile.mkstemp(dir=IMAGE_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    
+    evict_image_cache()
+
+
+def evict_image_cache() -> None:
+    """Usuwa najdawniej używane wpisy, gdy cache przekroczy IMAGE_CACHE_MAX_BYTES."""
+    entries = []
+    total = 0
+    for entry in os.scandir(IMAGE_CACHE_DIR):
+        if entry.name.endswith(('.json', '.tmp')):
+            continue
+        stat = entry.stat()
+        entries.append((stat.st_atime, stat.st_size, entry.path))
+        total += stat.st_size
+    
+    for _, size, path in sorted(entries):
+        if total <= IMAGE_CACHE_MAX_BYTES:
+            break
+        for stale in (path, f"{path}.json"):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def lookup_cached_image(url: str) -> Tuple[Optional[bytes], Dict[str, str]]:
+    """
+    Sprawdza cache dla URL.
+    
+    Zwraca (dane, {}) dla wpisu młodszego niż IMAGE_CACHE_TTL, w przeciwnym razie
+    (None, nagłówki warunkowego GET) - puste, gdy wpisu brak.
+    """
+    data_path, meta_path = get_cache_paths(url)
     try:
-        response = requests.get(url, timeout=30)
+        stat = os.stat(data_path)
+        if time.time() - stat.st_mtime < IMAGE_CACHE_TTL:
+            os.utime(data_path, (time.time(), stat.st_mtime))
+            with open(data_path, 'rb') as f:
+                return f.read(), {}
+        
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None, {}
+    
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return None, headers
+
+
+def read_cached_image(url: str) -> Optional[bytes]:
+    """Czyta wpis cache po odpowiedzi 304 i odświeża jego czas; None, jeśli wpis usunięto."""
+    data_path, _ = get_cache_paths(url)
+    try:
+        os.utime(data_path)
+        with open(data_path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+async def download_image(client: httpx.AsyncClient, url: str) -> Optional[bytes]:
+    """
+    Pobiera obraz z URL i zwraca jego zawartość.
+    
+    Wpisy cache są rewalidowane przez If-None-Match / If-Modified-Since
+    (bez zapytania HTTP tylko, gdy są młodsze niż IMAGE_CACHE_TTL).
+    Operacje na dysku cache wykonywane są poza pętlą zdarzeń.
+    """
+    try:
+        cached, headers = await asyncio.to_thread(lookup_cached_image, url)
+        if cached is not None:
+            return cached
+        
+        response = await client.get(url, timeout=30, headers=headers)
+        
+        if response.status_code == 304:
+            # Obraz bez zmian - użyj kopii z cache
+            cached = await asyncio.to_thread(read_cached_image, url)
+            if cached is not None:
+                return cached
+            # Wpis usunięty w międzyczasie (eviction) - zwykłe pobranie
+            response = await client.get(url, timeout=30)
+        
         response.raise_for_status()
         
-        filepath = os.path.join(temp_dir, filename)
-        with open(filepath, 'wb') as f:
-            f.write(response.content)
+        # Bez ETag / Last-Modified wpisu nie da się rewalidować - przy TTL 0 jest bezużyteczny
+        can_revalidate = "etag" in response.headers or "last-modified" in response.headers
+        if can_revalidate or IMAGE_CACHE_TTL > 0:
+            try:
+                await asyncio.to_thread(store_cached_image, url, response.content, response.headers)
+            except OSError as e:
+                print(f"Błąd zapisu obrazu do cache {url}: {e}")
         
-        return filepath
+        return response.content
     except Exception as e:
         print(f"Błąd pobierania obrazu {url}: {e}")
         return None
 
 
-def create_full_page_image_pdf(image_path: str, output_path: str) -> str:
-    """Tworzy PDF z obrazem na całą stronę A4."""
-    c = canvas.Canvas(output_path, pagesize=A4)
+async def download_images(jobs: Dict[str, str]) -> Dict[str, Optional[bytes]]:
+    """
+    Pobiera równolegle wszystkie obrazy.
+    
+    Przyjmuje słownik {klucz: url}, zwraca {klucz: zawartość lub None}.
+    """
+    if not jobs:
+        return {}
     
-    img = Image.open(image_path)
-    img_width, img_height = img.size
+    contents = await asyncio.gather(
+        *[download_image(app.state.http, url) for url in jobs.values()]
+    )
+    
+    return dict(zip(jobs.keys(), contents))
+
+
+def is_oversized(data: bytes, max_px: int = MAX_IMAGE_PX) -> bool:
+    """Sprawdza (tylko z nagłówka obrazu), czy dłuższy bok przekracza max_px."""
+    try:
+        img = pyvips.Image.new_from_buffer(data, "", access='sequential')
+    except pyvips.Error:
+        return False
+    return img.width > max_px or img.height > max_px
+
+
+def downscale_if_needed(data: bytes, max_px: int = MAX_IMAGE_PX) -> bytes:
+    """
+    Zmniejsza obraz, którego dłuższy bok przekracza max_px (ten sam format).
+    
+    libvips dekoduje strumieniowo, więc duże obrazy nie trafiają w całości do pamięci.
+    Dane, których libvips nie potrafi odczytać, zwracane są bez zmian.
+    """
+    try:
+        img = pyvips.Image.new_from_buffer(data, "", access='sequential')
+        if img.width <= max_px and img.height <= max_px:
+            return data
+        
+        suffix = '.jpg[Q=90]' if img.get('vips-loader').startswith('jpeg') else '.png'
+        thumb = pyvips.Image.thumbnail_buffer(data, max_px, height=max_px, size='down')
+        return thumb.write_to_buffer(suffix)
+    except pyvips.Error as e:
+        print(f"Nie można przeskalować obrazu: {e}")
+        return data
+
+
+def add_full_page_image(pdf: pikepdf.Pdf, image_data: bytes) -> None:
+    """
+    Dodaje do PDF stronę A4 wypełnioną obrazem (bez pośredniego PDF).
+    
+    JPEG trafia do dokumentu bez dekodowania, pozostałe formaty jako surowe
+    piksele skompresowane FlateDecode.
+    """
+    image_data = downscale_if_needed(image_data)
+    
+    with Image.open(io.BytesIO(image_data)) as img:
+        img_width, img_height = img.size
+        
+        if img.format == 'JPEG' and img.mode in ('RGB', 'L'):
+            data = image_data
+            image_filter = pikepdf.Name.DCTDecode
+            mode = img.mode
+        else:
+            pixels = img if img.mode in ('RGB', 'L') else img.convert('RGB')
+            data = zlib.compress(pixels.tobytes())
+            image_filter = pikepdf.Name.FlateDecode
+            mode = pixels.mode
+    
+    image = pikepdf.Stream(pdf, b'')
+    image.write(data, filter=image_filter)
+    image.Type = pikepdf.Name.XObject
+    image.Subtype = pikepdf.Name.Image
+    image.Width = img_width
+    image.Height = img_height
+    image.ColorSpace = pikepdf.Name.DeviceGray if mode == 'L' else pikepdf.Name.DeviceRGB
+    image.BitsPerComponent = 8
     
     scale_w = PAGE_WIDTH / img_width
     scale_h = PAGE_HEIGHT / img_height
@@ -348,122 +626,421 @@ def create_full_page_image_pdf(image_path: str, output_path: str) -> str:
     x = (PAGE_WIDTH - new_width) / 2
     y = (PAGE_HEIGHT - new_height) / 2
     
-    c.drawImage(image_path, x, y, new_width, new_height)
-    c.save()
+    page = pdf.add_blank_page(page_size=(PAGE_WIDTH, PAGE_HEIGHT))
+    name = page.add_resource(image, pikepdf.Name.XObject, prefix='Im')
+    page.obj.Contents = pdf.make_stream(
+        f"q {new_width:.4f} 0 0 {new_height:.4f} {x:.4f} {y:.4f} cm {name} Do Q".encode()
+    )
+
+
+def create_process_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Tworzy pulę procesów do renderowania i składania PDF."""
+    # spawn zamiast fork - proces główny ma już wątki i działającą pętlę zdarzeń
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=PDF_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+async def run_in_pool(func, *args):
+    """
+    Uruchamia blokującą funkcję CPU w puli procesów, nie blokując pętli zdarzeń.
+    
+    Śmierć jednego procesu (np. OOM) psuje całą pulę - wtedy zastępujemy ją nową
+    i ponawiamy zadanie jeden raz.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = app.state.pool
+        try:
+            return await loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool:
+            # Pulę wymienia tylko pierwsze żądanie, które zauważyło awarię
+            if app.state.pool is pool:
+                app.state.pool = create_process_pool()
+                pool.shutdown(wait=False)
+            if attempt:
+                raise
+
+
+# Wirtualny adres dokumentu - HTML i obrazy podawane rendererom z pamięci
+ASSETS_BASE_URL = "http://fotz.local/"
+
+
+def render_with_weasyprint(html_str: str, assets: Dict[str, bytes]) -> bytes:
+    """Renderuje PDF WeasyPrintem (wywoływane w procesie z puli)."""
+    # Import w procesie roboczym - główny proces nie ładuje WeasyPrint
+    from weasyprint import HTML, default_url_fetcher
+    
+    def fetch_asset(url):
+        if url.startswith(ASSETS_BASE_URL):
+            name = url[len(ASSETS_BASE_URL):].split('?')[0]
+            if name in assets:
+                return {"string": assets[name]}
+        return default_url_fetcher(url)
     
-    return output_path
+    return HTML(string=html_str, base_url=ASSETS_BASE_URL, url_fetcher=fetch_asset).write_pdf(
+        stylesheets=[get_weasyprint_stylesheet()]
+    )
+
+
+async def get_browser():
+    """Zwraca działające Chromium - po awarii (np. OOM) uruchamia je ponownie."""
+    async with app.state.browser_lock:
+        if not app.state.browser.is_connected():
+            app.state.browser = await app.state.playwright.chromium.launch()
+        return app.state.browser
+
+
+async def render_html_to_pdf(html_str: str, assets: Dict[str, bytes]) -> bytes:
+    """
+    Renderuje HTML do PDF silnikiem wybranym w RENDERER, bez zapisu na dysk.
+    
+    Względne ścieżki obrazów (np. "logo.png") wskazują klucze słownika assets.
+    Numery stron dodaje dopiero assemble_pdf - jednakowo dla obu silników.
+    """
+    if RENDERER == "weasyprint":
+        return await run_in_pool(render_with_weasyprint, html_str, assets)
+    
+    async def serve_asset(route):
+        name = route.request.url[len(ASSETS_BASE_URL):].split('?')[0]
+        if not name:
+            await route.fulfill(body=html_str, content_type="text/html; charset=utf-8")
+        elif name in assets:
+            await route.fulfill(body=assets[name])
+        else:
+            await route.fulfill(status=404)
+    
+    async def block_external(route):
+        # Treść może zawierać surowy HTML - poza obrazami nic nie wychodzi na zewnątrz
+        if route.request.resource_type == "image":
+            await route.continue_()
+        else:
+            await route.abort()
+    
+    # Bez JavaScriptu - handlery typu <img onerror=...> z treści nie są wykonywane
+    page = await (await get_browser()).new_page(java_script_enabled=False)
+    try:
+        # Trasy sprawdzane są od ostatnio dodanej - zasoby z pamięci mają pierwszeństwo
+        await page.route("**", block_external)
+        await page.route(f"{ASSETS_BASE_URL}**", serve_asset)
+        await page.goto(ASSETS_BASE_URL, wait_until="load")
+        await page.add_style_tag(content=FOTZ_CSS)
+        await page.evaluate("document.fonts.ready.then(() => true)")
+        return await page.pdf(
+            format="A4",
+            margin={"top": "2cm", "right": "2cm", "bottom": "2.5cm", "left": "2cm"},
+            print_background=True,
+            # Zakładki z nagłówków h1-h4 i struktura dokumentu, jak w WeasyPrint
+            outline=True,
+            tagged=True,
+        )
+    finally:
+        await page.close()
+
+
+def stamp_page_numbers(pdf: pikepdf.Pdf, first: int, last: int) -> None:
+    """
+    Numeruje strony first..last-1 (od 1) w środku dolnego marginesu.
+    
+    Numery nanoszone są zawsze po złożeniu - wygląd stopki nie zależy od silnika
+    ani od tego, czy treść renderowana była w częściach.
+    """
+    font = pdf.make_indirect(pikepdf.Dictionary(
+        Type=pikepdf.Name.Font,
+        Subtype=pikepdf.Name.Type1,
+        BaseFont=pikepdf.Name.Helvetica,
+        Encoding=pikepdf.Name.WinAnsiEncoding,
+    ))
+    font_size = 10
+    # Środek dolnego marginesu (2.5cm), linia bazowa obniżona o pół wysokości cyfr
+    y = 2.5 / 2.54 * 72 / 2 - 3.5
+    
+    for number, index in enumerate(range(first, last), 1):
+        page = pdf.pages[index]
+        label = str(number)
+        # Cyfry Helvetiki mają stałą szerokość 0.556 em
+        x = (PAGE_WIDTH - len(label) * 0.556 * font_size) / 2
+        name = page.add_resource(font, pikepdf.Name.Font, prefix='FotzPageNo')
+        
+        # Oryginalną treść zamykamy w q/Q, aby jej stan graficzny nie wpływał na numer
+        page.contents_add(pdf.make_stream(b"q\n"), prepend=True)
+        page.contents_add(pdf.make_stream(
+            f"\nQ q 0.4 g BT {name} {font_size} Tf {x:.2f} {y:.2f} Td ({label}) Tj ET Q".encode()
+        ))
+
+
+def resolve_outline_destination(src: pikepdf.Pdf, item: pikepdf.OutlineItem) -> Optional[pikepdf.Array]:
+    """Zwraca jawny cel zakładki ([strona, /XYZ, ...]), rozwijając cele nazwane i akcje GoTo."""
+    dest = item.destination
+    if dest is None and item.action is not None and item.action.get('/S') == pikepdf.Name.GoTo:
+        dest = item.action.get('/D')
+    
+    if isinstance(dest, pikepdf.String) and '/Dests' in src.Root.get('/Names', {}):
+        dest = pikepdf.NameTree(src.Root.Names.Dests).get(str(dest))
+    elif isinstance(dest, pikepdf.Name) and '/Dests' in src.Root:
+        dest = src.Root.Dests.get(dest)
+    
+    if isinstance(dest, pikepdf.Dictionary):
+        dest = dest.get('/D')
+    if isinstance(dest, pikepdf.Array) and len(dest) > 0:
+        return dest
+    return None
+
+
+def copy_outline(src: pikepdf.Pdf, items: List[pikepdf.OutlineItem], out: pikepdf.Pdf,
+                 offset: int, page_index: Dict[Tuple[int, int], int]) -> List[pikepdf.OutlineItem]:
+    """
+    Przenosi zakładki z src do out - strony przesunięte o offset (okładka, wcześniejsze części).
+    
+    Zakładki bez rozpoznawalnego celu zostają, aby nie gubić ich dzieci.
+    """
+    copied = []
+    for item in items:
+        dest = resolve_outline_destination(src, item)
+        destination = None
+        if dest is not None and dest[0].objgen in page_index:
+            target = out.pages[offset + page_index[dest[0].objgen]]
+            destination = pikepdf.Array([target.obj, *list(dest)[1:]])
+        
+        new_item = pikepdf.OutlineItem(item.title, destination)
+        new_item.children.extend(copy_outline(src, item.children, out, offset, page_index))
+        copied.append(new_item)
+    return copied
+
+
+def assemble_pdf(cover: Optional[bytes], content_pdfs: List[bytes],
+                 infographics: List[bytes]) -> bytes:
+    """
+    Składa finalny PDF (okładka, treść, infografiki) i zwraca go bez zapisu na dysk.
+    
+    Treść może składać się z kilku PDF-ów (rozdziały renderowane równolegle);
+    strony treści dostają ciągłą numerację, a zakładki wszystkich części trafiają do jednego spisu.
+    """
+    buffer = io.BytesIO()
+    
+    with pikepdf.Pdf.new() as out:
+        if cover:
+            add_full_page_image(out, cover)
+        
+        content_start = len(out.pages)
+        sources = [pikepdf.Pdf.open(io.BytesIO(content_pdf)) for content_pdf in content_pdfs]
+        try:
+            # QPDF kopiuje strony przez referencje; zakładki trzeba przenieść osobno
+            with out.open_outline() as outline:
+                for content in sources:
+                    offset = len(out.pages)
+                    out.pages.extend(content.pages)
+                    page_index = {page.objgen: i for i, page in enumerate(content.pages)}
+                    with content.open_outline() as content_outline:
+                        outline.root.extend(
+                            copy_outline(content, content_outline.root, out, offset, page_index)
+                        )
+            
+            stamp_page_numbers(out, content_start, len(out.pages))
+            
+            for infographic in infographics:
+                add_full_page_image(out, infographic)
+            
+            out.save(buffer, linearize=True)
+        finally:
+            for content in sources:
+                content.close()
+    
+    return buffer.getvalue()
+
+
+def split_chapters(content_html: str, max_parts: int) -> List[str]:
+    """
+    Dzieli HTML treści na najwyżej max_parts części o zbliżonej długości,
+    tnąc wyłącznie przed nagłówkami <h1> (każdy rozdział i tak zaczyna nową stronę).
+    """
+    chapters = [ch for ch in re.split(r'(?m)^(?=<h1[ >])', content_html) if ch.strip()]
+    if len(chapters) <= 1 or max_parts <= 1:
+        return [content_html]
+    
+    target = len(content_html) / max_parts
+    parts, current = [], []
+    current_len = 0
+    for chapter in chapters:
+        current.append(chapter)
+        current_len += len(chapter)
+        if current_len >= target and len(parts) < max_parts - 1:
+            parts.append(''.join(current))
+            current, current_len = [], 0
+    if current:
+        parts.append(''.join(current))
+    
+    return parts
+
+
+def build_document_html(title: str, body: str) -> str:
+    """Opakowuje treść w pełny dokument HTML."""
+    return f'''<!DOCTYPE html>
+<html lang="pl">
+<head>
+    <meta charset="UTF-8">
+    <title>{html.escape(title)}</title>
+</head>
+<body>
+{body}
+</body>
+</html>'''
 
 
 def generate_toc_html(toc_items: List[TocItem]) -> str:
     """Generuje HTML spisu treści."""
-    html = f'''
+    parts = [f'''
     <h2 style="color: {BRANDING["primary_color"]}; border-bottom: 2px solid {BRANDING["primary_color"]}; padding-bottom: 10px; page-break-before: avoid;">
         SPIS TREŚCI
     </h2>
     <div class="toc">
-    '''
+    ''']
     
-    for item in toc_items:
-        html += f'''
+    parts.extend(
+        f'''
         <div class="toc-item">
-            <span class="toc-title">{item.title}</span>
+            <span class="toc-title">{html.escape(item.title)}</span>
             <span class="toc-page">{item.page}</span>
         </div>
         '''
+        for item in toc_items
+    )
     
-    html += '</div>'
-    return html
+    parts.append('</div>')
+    return ''.join(parts)
+
 
+def get_image_jobs(request: PdfRequest) -> Dict[str, str]:
+    """Zwraca obrazy potrzebne do PDF jako {klucz: url} (okładka, logo, infografiki)."""
+    jobs = {}
+    if request.cover_url:
+        jobs["cover"] = request.cover_url
+    if request.logo_url:
+        jobs["logo"] = request.logo_url
+    for i, url in enumerate(request.infographic_urls or []):
+        jobs[f"infographic_{i}"] = url
+    return jobs
 
-def generate_pdf_from_content(request: PdfRequest, temp_dir: str) -> bytes:
-    """Generuje PDF z przetłumaczonej treści."""
+
+async def generate_pdf_from_content(request: PdfRequest,
+                                    images: Optional[Dict[str, Optional[bytes]]] = None) -> bytes:
+    """
+    Generuje PDF z przetłumaczonej treści (w całości w pamięci).
     
-    # 1. Przetwórz treść (formatowanie FOTZ)
-    processed_content = process_content(request.content, request.keywords_to_bold)
+    images: obrazy pobrane wcześniej przez wywołującego (klucze jak w get_image_jobs);
+    jeśli nie podano, zostaną pobrane tutaj.
+    """
+    
+    # 0. Pobierz równolegle wszystkie obrazy (okładka, logo, infografiki)
+    if images is None:
+        images = await download_images(get_image_jobs(request))
     
-    # 2. Konwertuj Markdown na HTML
-    content_html = markdown.markdown(processed_content, extensions=['tables', 'fenced_code'])
+    # 1-2. Przetwórz treść (formatowanie FOTZ) i skonwertuj Markdown na HTML
+    content_html = render_content_html(request.content, tuple(request.keywords_to_bold or ()))
     
     # 3. Generuj spis treści
     toc_html = ""
     if request.toc_items:
         toc_html = generate_toc_html(request.toc_items)
     
-    # 4. Pobierz logo jeśli podano URL
+    # 4. Dodaj logo jeśli zostało pobrane
     logo_html = ""
-    if request.logo_url:
-        logo_path = download_image(request.logo_url, temp_dir, "logo.png")
-        if logo_path:
-            logo_html = f'''
-            <div style="page-break-before: always; text-align: center; padding-top: 200pt;">
-                <img src="file://{logo_path}" style="width: 150pt; height: auto;" />
-                <p style="margin-top: 30pt; font-size: 14pt; color: {BRANDING["secondary_color"]};">
-                    FOTZ Studio
-                </p>
-                <p><a href="https://fotz.pl" style="color: {BRANDING["secondary_color"]};">fotz.pl</a></p>
-            </div>
-            '''
-    
-    # 5. Stwórz pełny dokument HTML
-    full_html = f'''<!DOCTYPE html>
-<html lang="pl">
-<head>
-    <meta charset="UTF-8">
-    <title>{request.title}</title>
-    <style>{get_fotz_css()}</style>
-</head>
-<body>
-{toc_html}
-{content_html}
-{logo_html}
-</body>
-</html>'''
-    
-    # 6. Zapisz HTML do pliku tymczasowego
-    html_path = os.path.join(temp_dir, "content.html")
-    with open(html_path, 'w', encoding='utf-8') as f:
-        f.write(full_html)
+    assets = {}
+    if images.get("logo"):
+        assets["logo.png"] = images["logo"]
+        logo_html = f'''
+        <div style="page-break-before: always; text-align: center; padding-top: 200pt;">
+            <img src="logo.png" style="width: 150pt; height: auto;" />
+            <p style="margin-top: 30pt; font-size: 14pt; color: {BRANDING["secondary_color"]};">
+                FOTZ Studio
+            </p>
+            <p><a href="https://fotz.pl" style="color: {BRANDING["secondary_color"]};">fotz.pl</a></p>
+        </div>
+        '''
     
-    # 7. Konwertuj HTML na PDF (treść)
-    content_pdf_path = os.path.join(temp_dir, "content.pdf")
-    HTML(filename=html_path).write_pdf(content_pdf_path)
+    # 5. Podziel duże ebooki na grupy rozdziałów (jedna grupa = jeden dokument HTML)
+    parts = [content_html]
+    if len(content_html) >= CHAPTER_SPLIT_MIN_CHARS:
+        parts = split_chapters(content_html, PDF_WORKERS)
+    parts[0] = f"{toc_html}\n{parts[0]}"
+    parts[-1] = f"{parts[-1]}\n{logo_html}"
     
-    # 8. Połącz wszystkie PDFy
-    merger = PdfMerger()
+    # 6. Konwertuj HTML na PDF (treść) - części równolegle, numeracja stron po złożeniu
+    content_pdfs = await asyncio.gather(*[
+        render_html_to_pdf(build_document_html(request.title, part), assets)
+        for part in parts
+    ])
     
-    # Okładka (jeśli podano)
-    if request.cover_url:
-        cover_path = download_image(request.cover_url, temp_dir, "cover.png")
-        if cover_path:
-            cover_pdf_path = os.path.join(temp_dir, "cover.pdf")
-            create_full_page_image_pdf(cover_path, cover_pdf_path)
-            merger.append(cover_pdf_path)
-    
-    # Treść
-    merger.append(content_pdf_path)
-    
-    # Infografiki (jeśli podano)
-    if request.infographic_urls:
-        for i, url in enumerate(request.infographic_urls):
-            inf_path = download_image(url, temp_dir, f"infographic_{i}.png")
-            if inf_path:
-                inf_pdf_path = os.path.join(temp_dir, f"infographic_{i}.pdf")
-                create_full_page_image_pdf(inf_path, inf_pdf_path)
-                merger.append(inf_pdf_path)
-    
-    # 9. Zapisz finalny PDF
-    final_pdf_path = os.path.join(temp_dir, "final.pdf")
-    merger.write(final_pdf_path)
-    merger.close()
-    
-    # 10. Wczytaj i zwróć jako bytes
-    with open(final_pdf_path, 'rb') as f:
-        return f.read()
+    # 7. Połącz okładkę, treść i infografiki, zwróć jako bytes
+    infographics = [
+        images[f"infographic_{i}"]
+        for i in range(len(request.infographic_urls or []))
+        if images.get(f"infographic_{i}")
+    ]
+    return await run_in_pool(assemble_pdf, images.get("cover"), list(content_pdfs), infographics)
 
 # =============================================================================
 # ENDPOINTY API
 # =============================================================================
 
+@app.on_event("startup")
+async def start_process_pool():
+    """Tworzy pulę procesów do renderowania i składania PDF."""
+    app.state.pool = create_process_pool()
+
+
+@app.on_event("shutdown")
+async def stop_process_pool():
+    """Zamyka pulę procesów."""
+    app.state.pool.shutdown()
+
+
+@app.on_event("startup")
+async def start_http_client():
+    """Tworzy współdzielonego klienta HTTP/2 - połączenia TLS są używane ponownie między żądaniami."""
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=30,
+        # Jak requests.get - obrazy za przekierowaniem (http->https, CDN) nie mogą przepaść
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+    )
+
+
+@app.on_event("shutdown")
+async def stop_http_client():
+    """Zamyka klienta HTTP."""
+    await app.state.http.aclose()
+
+
+@app.on_event("startup")
+async def start_renderer():
+    """Uruchamia jedną instancję Chromium współdzieloną przez wszystkie żądania."""
+    if RENDERER == "chromium":
+        app.state.playwright = await async_playwright().start()
+        app.state.browser = await app.state.playwright.chromium.launch()
+        app.state.browser_lock = asyncio.Lock()
+
+
+@app.on_event("shutdown")
+async def stop_renderer():
+    """Zamyka przeglądarkę przy wyłączaniu serwisu."""
+    if RENDERER == "chromium":
+        await app.state.browser.close()
+        await app.state.playwright.stop()
+
+
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request, exc: StarletteHTTPException):
+    """Zwraca błędy HTTP przez orjson - domyślny handler FastAPI zawsze używa JSONResponse."""
+    return ORJSONResponse(
+        {"detail": exc.detail},
+        status_code=exc.status_code,
+        headers=getattr(exc, "headers", None)
+    )
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -487,18 +1064,17 @@ async def generate_pdf(request: PdfRequest):
     Zwraca: Plik PDF
     """
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            pdf_bytes = generate_pdf_from_content(request, temp_dir)
-            
-            # Generuj nazwę pliku
-            safe_title = re.sub(r'[^\w\s-]', '', request.title).replace(' ', '_')
-            filename = f"{safe_title}.pdf"
-            
-            return StreamingResponse(
-                io.BytesIO(pdf_bytes),
-                media_type="application/pdf",
-                headers={"Content-Disposition": f"attachment; filename={filename}"}
-            )
+        pdf_bytes = await generate_pdf_from_content(request)
+        
+        # Generuj nazwę pliku
+        safe_title = re.sub(r'[^\w\s-]', '', request.title).replace(' ', '_')
+        filename = f"{safe_title}.pdf"
+        
+        return StreamingResponse(
+            io.BytesIO(pdf_bytes),
+            media_type="application/pdf",
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Błąd generowania PDF: {str(e)}")
@@ -512,74 +1088,71 @@ async def generate_zip(request: ZipRequest):
     Zwraca: Archiwum ZIP zawierające PDF, grafiki i treści marketingowe.
     """
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            zip_buffer = io.BytesIO()
-            
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                
-                # 1. Generuj PDF
-                pdf_request = PdfRequest(
-                    content=request.pdf_content,
-                    title=request.title,
-                    subtitle=request.subtitle,
-                    author=request.author,
-                    toc_items=request.toc_items,
-                    keywords_to_bold=request.keywords_to_bold,
-                    cover_url=request.cover_url,
-                    infographic_urls=request.infographic_urls,
-                    logo_url=request.logo_url
-                )
-                pdf_bytes = generate_pdf_from_content(pdf_request, temp_dir)
-                
-                safe_title = re.sub(r'[^\w\s-]', '', request.title).replace(' ', '_')
-                zipf.writestr(f"{safe_title}.pdf", pdf_bytes)
-                
-                # 2. Dodaj okładkę
-                if request.cover_url:
-                    cover_path = download_image(request.cover_url, temp_dir, "cover_dl.png")
-                    if cover_path:
-                        with open(cover_path, 'rb') as f:
-                            zipf.writestr("cover_a4.png", f.read())
-                
-                # 3. Dodaj mockup
-                if request.mockup_url:
-                    mockup_path = download_image(request.mockup_url, temp_dir, "mockup_dl.png")
-                    if mockup_path:
-                        with open(mockup_path, 'rb') as f:
-                            zipf.writestr("mockup_tablet.png", f.read())
-                
-                # 4. Dodaj infografiki
-                if request.infographic_urls:
-                    for i, url in enumerate(request.infographic_urls, 1):
-                        inf_path = download_image(url, temp_dir, f"inf_{i}_dl.png")
-                        if inf_path:
-                            with open(inf_path, 'rb') as f:
-                                zipf.writestr(f"infographic_{i}.png", f.read())
-                
-                # 5. Dodaj blog post
-                if request.blog_post:
-                    zipf.writestr("blog_post.md", request.blog_post.encode('utf-8'))
-                
-                # 6. Dodaj opis sklepu
-                if request.shop_description:
-                    zipf.writestr("opis_sklepu.md", request.shop_description.encode('utf-8'))
-                
-                # 7. Dodaj logo
-                if request.logo_url:
-                    logo_path = download_image(request.logo_url, temp_dir, "logo_dl.png")
-                    if logo_path:
-                        with open(logo_path, 'rb') as f:
-                            zipf.writestr("logo_fotz.png", f.read())
-            
-            zip_buffer.seek(0)
-            
-            filename = f"{safe_title}_FOTZ.zip"
-            
-            return StreamingResponse(
-                zip_buffer,
-                media_type="application/zip",
-                headers={"Content-Disposition": f"attachment; filename={filename}"}
-            )
+        # 1. Pobierz grafiki i wygeneruj PDF
+        # Dane są już zwalidowane w ZipRequest - bez ponownej walidacji i kopiowania treści
+        pdf_request = PdfRequest.model_construct(
+            content=request.pdf_content,
+            title=request.title,
+            subtitle=request.subtitle,
+            author=request.author,
+            toc_items=request.toc_items,
+            keywords_to_bold=request.keywords_to_bold,
+            cover_url=request.cover_url,
+            infographic_urls=request.infographic_urls,
+            logo_url=request.logo_url
+        )
+        
+        # Każdy URL pobierany raz - te same bajty trafiają do PDF i do paczki
+        jobs = get_image_jobs(pdf_request)
+        if request.mockup_url:
+            jobs["mockup"] = request.mockup_url
+        images = await download_images(jobs)
+        
+        # Nazwy plików w paczce (okładka, mockup, infografiki, logo)
+        zip_names = {"cover": "cover_a4.png", "mockup": "mockup_tablet.png"}
+        for i in range(len(request.infographic_urls or [])):
+            zip_names[f"infographic_{i}"] = f"infographic_{i + 1}.png"
+        zip_names["logo"] = "logo_fotz.png"
+        keys = [key for key in zip_names if images.get(key)]
+        names = [zip_names[key] for key in keys]
+        
+        # PDF oraz grafiki do paczki (ograniczone do A4 @ 300 DPI) równolegle;
+        # do puli trafiają tylko obrazy, które faktycznie trzeba zmniejszyć
+        async def prepare_zip_image(data):
+            if is_oversized(data):
+                return await run_in_pool(downscale_if_needed, data)
+            return data
+        
+        pdf_bytes, resized = await asyncio.gather(
+            generate_pdf_from_content(pdf_request, images),
+            asyncio.gather(*[prepare_zip_image(images[key]) for key in keys])
+        )
+        
+        # PDF i grafiki są już skompresowane - zapisywane bez kompresji, deflate tylko dla .md
+        zs = ZipStream(compress_type=zipfile.ZIP_STORED)
+        
+        safe_title = re.sub(r'[^\w\s-]', '', request.title).replace(' ', '_')
+        zs.add(pdf_bytes, f"{safe_title}.pdf")
+        
+        # 2. Dodaj grafiki (okładka, mockup, infografiki, logo)
+        for name, data in zip(names, resized):
+            zs.add(data, name)
+        
+        # 3. Dodaj blog post
+        if request.blog_post:
+            zs.add(request.blog_post.encode('utf-8'), "blog_post.md", compress_type=zipfile.ZIP_DEFLATED)
+        
+        # 4. Dodaj opis sklepu
+        if request.shop_description:
+            zs.add(request.shop_description.encode('utf-8'), "opis_sklepu.md", compress_type=zipfile.ZIP_DEFLATED)
+        
+        filename = f"{safe_title}_FOTZ.zip"
+        
+        return StreamingResponse(
+            zs,
+            media_type="application/zip",
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Błąd generowania ZIP: {str(e)}")